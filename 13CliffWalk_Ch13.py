@@ -1,10 +1,12 @@
+import os
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from collections import namedtuple, deque
-from torch.distributions import Categorical
+from collections import namedtuple
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 # configurations
 gamma = 1.00
@@ -12,6 +14,9 @@ lr = 1e-4
 best_score = -14
 log_interval = 10
 test_interval = 20
+num_envs = 16
+use_compile = True
+n_steps = 5
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 Transition = namedtuple('Transition', ('state', 'next_state', 'action', 'reward', 'mask'))
 torch.manual_seed(1111)
@@ -19,15 +24,19 @@ np.random.seed(1111)
 
 
 class CliffWalking(object):
-    def __init__(self):
+    def __init__(self, batch_size=1, device=device):
         self.shape = (4, 12)
+        self.batch_size = batch_size
+        self.device = device
 
         # always start from the left-dow corner
-        self.pos = np.asarray([self.shape[0] - 1, 0])
+        self.start = torch.tensor([self.shape[0] - 1, 0], device=device)
+        self.start_state = torch.tensor((self.shape[0] - 1) * self.shape[1], device=device)
+        self.state = self.start_state.repeat(batch_size)
 
         # build a
-        self.cliff = np.zeros(self.shape, dtype=np.bool)
-        self.cliff[-1, 1:-1] = 1
+        self.cliff = torch.zeros(self.shape, dtype=torch.bool, device=device)
+        self.cliff[-1, 1:-1] = True
 
         self.actions = {
             'U': 0,
@@ -43,62 +52,59 @@ class CliffWalking(object):
             3: [0, 1]
         }
 
-        self.transmit_tensor = self._build_transmit_tensor_()
-
         self.num_actions = len(self.actions)
-        self.state_dim = 2
+        self.state_dim = 1
+
+        self.lut = self._build_transmit_tensor_()
 
     def _build_transmit_tensor_(self):
-        trans_matrix = [[[] for _ in range(self.shape[1])] for __ in range(self.shape[0])]
-        for i in range(self.shape[0]):
-            for j in range(self.shape[1]):
-                for a in range(len(self.actions)):
-                    trans_matrix[i][j].append(self._cal_new_position_((i, j), a))
-
-        return trans_matrix
-
-    def _cal_new_position_(self, old_pos, action):
-        old_pos = np.asarray(old_pos)
-        new_pos = old_pos + self.action2shift[action]
-        new_pos[0] = max(new_pos[0], 0)
-        new_pos[0] = min(new_pos[0], self.shape[0] - 1)
-        new_pos[1] = max(new_pos[1], 0)
-        new_pos[1] = min(new_pos[1], self.shape[1] - 1)
-
-        reward = -1.
-        terminate = False
-
-        if self.cliff[old_pos[0]][old_pos[1]]:
-            reward = -100.
-            new_pos[0] = self.shape[0] - 1
-            new_pos[1] = 0
-            terminate = False
-
-        if old_pos[0] == self.shape[0] - 1 and old_pos[1] == self.shape[1] - 1:
-            terminate = True
-            reward = 0.
-            new_pos[0] = self.shape[0] - 1
-            new_pos[1] = self.shape[1] - 1
-
-        return new_pos, reward, terminate
+        num_actions = len(self.actions)
+        grid = torch.meshgrid(torch.arange(self.shape[0], device=self.device),
+                              torch.arange(self.shape[1], device=self.device), indexing='ij')
+        old_pos = torch.stack(grid, dim=-1).unsqueeze(2).expand(-1, -1, num_actions, -1)
+        shift = torch.tensor([self.action2shift[a] for a in range(num_actions)], device=self.device)
+
+        upper = torch.tensor([self.shape[0] - 1, self.shape[1] - 1], device=self.device)
+        next_pos_lut = torch.minimum((old_pos + shift).clamp_min(0), upper)
+        reward_lut = torch.full(self.shape + (num_actions,), -1., device=self.device)
+        done_lut = torch.zeros(self.shape + (num_actions,), dtype=torch.bool, device=self.device)
+
+        on_cliff = self.cliff.unsqueeze(-1).expand(-1, -1, num_actions)
+        next_pos_lut[on_cliff] = self.start
+        reward_lut[on_cliff] = -100.
+
+        on_goal = torch.zeros(self.shape + (num_actions,), dtype=torch.bool, device=self.device)
+        on_goal[-1, -1] = True
+        next_pos_lut[on_goal] = upper
+        reward_lut[on_goal] = 0.
+        done_lut[on_goal] = True
+
+        next_state_lut = next_pos_lut[..., 0] * self.shape[1] + next_pos_lut[..., 1]
+        lut = torch.stack([next_state_lut, reward_lut.long(), done_lut.long()], dim=-1)
+        return lut.view(-1, 3)
+
+    def step(self, actions):
+        row = self.lut[self.state * self.num_actions + actions]
+        done = row[:, 2].bool()
+
+        # finished envs restart from the corner so the batch keeps its size
+        self.state = torch.where(done, self.start_state, row[:, 0])
+        return self.state, row[:, 1].float(), done
 
     def take_action(self, action):
-        if isinstance(action, str):
-            new_pos, reward, terminate = self.transmit_tensor[self.pos[0]][self.pos[1]][self.actions[action]]
-        else:
-            new_pos, reward, terminate = self.transmit_tensor[self.pos[0]][self.pos[1]][action]
-        self.pos[0] = new_pos[0]
-        self.pos[1] = new_pos[1]
-        return new_pos, reward, terminate
+        next_state, reward, terminate = self.lut[self.state[0] * self.num_actions + action].tolist()
+        self.state[0] = next_state
+        return list(divmod(next_state, self.shape[1])), float(reward), bool(terminate)
 
     def show_pos(self):
         env = np.zeros(self.shape)
-        env[self.pos[0]][self.pos[1]] = 1
+        i, j = divmod(self.state[0].item(), self.shape[1])
+        env[i][j] = 1
         print(env)
 
     def reset(self):
-        self.pos = np.asarray([self.shape[0] - 1, 0])
-        return self.pos
+        self.state = self.start_state.repeat(self.batch_size)
+        return self.state
 
 
 class REINFORCE(nn.Module):
@@ -122,28 +128,25 @@ class REINFORCE(nn.Module):
         return policy
 
     @classmethod
-    def train_model(cls, model, transitions, optimizer, gamma=1.0):
+    def train_model(cls, model, transitions, optimizer, state_table, gamma=1.0):
         states, actions, rewards, masks = transitions.state, transitions.action, transitions.reward, transitions.mask
 
-        states = torch.stack(states)
-        actions = torch.stack(actions)
-        rewards = torch.Tensor(rewards)
-        masks = torch.Tensor(masks)
-
-        returns = torch.zeros_like(rewards)
-
-        running_return = 0
-        for t in reversed(range(len(rewards))):
-            running_return = rewards[t] + gamma * running_return * masks[t]
-            returns[t] = running_return
+        if gamma == 1.0:
+            # the rollout already zeroes rewards after each env's terminal step
+            returns = torch.flip(torch.cumsum(torch.flip(rewards, [0]), dim=0), [0])
+        else:
+            returns = torch.zeros_like(rewards)
+            running_return = torch.zeros_like(rewards[0])
+            for t in reversed(range(len(rewards))):
+                running_return = rewards[t] + gamma * running_return * masks[t]
+                returns[t] = running_return
 
-        policies = model(states)
-        policies = policies.view(-1, model.output_dim)
+        policies = model(state_table[states])
 
-        log_policies = (torch.log(policies) * actions.detach()).sum(dim=1)
+        log_policies = torch.log(policies.gather(-1, actions.unsqueeze(-1))).squeeze(-1)
 
         optimizer.zero_grad()
-        loss = (-log_policies * returns).sum()
+        loss = (-log_policies * returns).sum() / rewards.size(1)
 
         loss.backward()
         optimizer.step()
@@ -155,8 +158,7 @@ class REINFORCE(nn.Module):
 
     def get_action(self, state):
         policy = self.forward(state)
-        m = Categorical(policy)
-        action = m.sample()
+        action = torch.multinomial(policy, num_samples=1).squeeze(-1)
         return action
 
 
@@ -183,20 +185,19 @@ class ActorCritic(nn.Module):
         return policy, value
 
     @classmethod
-    def train_model(cls, model, transition, optimizer, gamma=1.0):
+    def train_model(cls, model, transition, optimizer, state_table, gamma=1.0):
         state, next_state, action, reward, mask = transition
 
-        policy, value = model(state)
-        policy, value = policy.view(-1, model.output_dim), value.view(-1, 1)
-        _, next_value = model(next_state)
-        next_value = next_value.view(-1, 1)
+        policy, value = model(state_table[torch.cat([state, next_state], dim=0)])
+        policy, value, next_value = policy[:state.size(0)], value[:state.size(0)], value[state.size(0):]
+        value, next_value = value.squeeze(-1), next_value.detach().squeeze(-1)
 
-        target_plus_value = reward + mask * gamma * next_value[0]
-        target = target_plus_value - value[0]
+        target_plus_value = reward + mask * gamma * next_value
+        target = target_plus_value - value
 
-        log_policy = torch.log(policy[0])[action]
+        log_policy = torch.log(policy).gather(-1, action.unsqueeze(-1)).squeeze(-1)
         loss_policy = -log_policy * target.detach()
-        loss_value = F.mse_loss(target_plus_value.detach(), value[0])
+        loss_value = F.mse_loss(value, target_plus_value.detach(), reduction='none')
 
         loss = (loss_policy + loss_value).mean()
         optimizer.zero_grad()
@@ -207,159 +208,242 @@ class ActorCritic(nn.Module):
 
     def get_action(self, state):
         policy, _ = self.forward(state)
-        m = Categorical(policy)
-        action = m.sample()
+        action = torch.multinomial(policy, num_samples=1).squeeze(-1)
         return action
 
 
 class ReplayPool(object):
-    def __init__(self):
-        self.memory = deque()
+    def __init__(self, batch_size, capacity=1024, keep_next_states=True, device=device):
+        self.batch_size = batch_size
+        self.keep_next_states = keep_next_states
+        self.device = device
+
+        self.cursor = 0
+        self._allocate_(capacity)
+
+    def _allocate_(self, capacity):
+        self.states = torch.empty(capacity, self.batch_size, dtype=torch.long, device=self.device)
+        self.next_states = None
+        if self.keep_next_states:
+            self.next_states = torch.empty(capacity, self.batch_size, dtype=torch.long, device=self.device)
+        self.actions = torch.empty(capacity, self.batch_size, dtype=torch.long, device=self.device)
+        self.rewards = torch.empty(capacity, self.batch_size, device=self.device)
+        self.masks = torch.empty(capacity, self.batch_size, device=self.device)
+
+    def _grow_(self):
+        # episodes have no step limit, so double the storage rather than overwrite old steps
+        memory = self.pop_all()
+        self._allocate_(2 * self.states.size(0))
+        for buffer, data in zip(self.pop_all(), memory):
+            if buffer is not None:
+                buffer.copy_(data)
 
     def push(self, state, next_state, action, reward, mask):
-        self.memory.append(Transition(state, next_state, action, reward, mask))
+        if self.cursor == self.states.size(0):
+            self._grow_()
+
+        self.states[self.cursor] = state
+        if self.next_states is not None:
+            self.next_states[self.cursor] = next_state
+        self.actions[self.cursor] = action
+        self.rewards[self.cursor] = reward
+        self.masks[self.cursor] = mask
+        self.cursor += 1
 
     def pop_all(self):
-        memory = self.memory
-        return Transition(*zip(*memory))
+        next_states = self.next_states[:self.cursor] if self.next_states is not None else None
+        return Transition(self.states[:self.cursor], next_states,
+                          self.actions[:self.cursor], self.rewards[:self.cursor], self.masks[:self.cursor])
 
     def reset(self):
-        self.memory = deque()
+        self.cursor = 0
 
     def __len__(self):
-        return len(self.memory)
+        return self.cursor
 
 
 def test_cliff_warlking_by_hand(cw):
-    _, reward, terminate = cw.transmit_tensor[3][0][0]
+    terminate = False
     cw.show_pos()
     score = 0
     while not terminate:
         action = input('input your actoin (U/D/L/R):')
-        new_pos, reward, terminate = cw.take_action(action)
+        new_pos, reward, terminate = cw.take_action(cw.actions[action])
         score += reward
         print(new_pos, reward, terminate, score)
         cw.show_pos()
 
 
-def convert_state2onehot(state, state_dim=48):
-    state_one_hot = np.zeros(state_dim)
-    state_one_hot[state[0] * 5 + state[1]] = 1.
-    state_one_hot = torch.Tensor(state_one_hot).to(device).unsqueeze(0)
-    return state_one_hot
+def compile_forward(model, example):
+    if use_compile and example.device.type == 'cuda' and hasattr(torch, 'compile'):
+        eager_forward = model.forward
+        try:
+            model.forward = torch.compile(eager_forward, dynamic=True)
+            model(example)
+        except RuntimeError as err:
+            print('torch.compile failed, running eager: %s' % err)
+            model.forward = eager_forward
+    return model
 
 
-def train_REINFORCE(env, state_shape=[4,12]):
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def wrap_distributed(model, device):
+    if not is_distributed():
+        return model
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DDP(model, device_ids=device_ids)
+
+
+def any_alive(alive):
+    alive = alive.any().int()
+    if is_distributed():
+        dist.all_reduce(alive, op=dist.ReduceOp.MAX)
+    return bool(alive)
+
+
+def evaluate(model, test_env, state_table):
+    model.eval()
+    with torch.inference_mode():
+        state = test_env.reset()
+        alive = torch.ones(test_env.batch_size, dtype=torch.bool, device=test_env.device)
+        scores = torch.zeros(test_env.batch_size, device=test_env.device)
+        while alive.any():
+            action = model.get_action(state_table[state])
+            state, reward, terminate = test_env.step(action)
+            scores += reward * alive
+            alive = alive & ~terminate
+    model.train()
+    return scores.mean().item()
+
+
+def train_REINFORCE(env, state_shape=[4,12], num_episodes=6000):
     model = REINFORCE(state_shape[0] * state_shape[1], env.num_actions)
 
     optimizer = optim.Adam(model.parameters(), lr=lr)
 
-    model.to(device)
+    model.to(env.device)
     model.train()
-    replay_pool = ReplayPool()
+    state_table = torch.eye(state_shape[0] * state_shape[1], device=env.device)
+    compile_forward(model, state_table[:env.batch_size])
+    net = wrap_distributed(model, env.device)
+    is_main = not is_distributed() or dist.get_rank() == 0
+    replay_pool = ReplayPool(env.batch_size, keep_next_states=False, device=env.device)
+    test_env = CliffWalking(batch_size=100, device=env.device)
 
-    for e in range(6000):
+    step, push = env.step, replay_pool.push
+    get_action = model.get_action
+
+    for b in range(num_episodes // env.batch_size):
         state = env.reset()
-        terminate = False
+        alive = torch.ones(env.batch_size, dtype=torch.bool, device=env.device)
         replay_pool.reset()
 
-        # create an episode
-        while not terminate:
-            state_one_hot = convert_state2onehot(state, state_dim=state_shape[0] * state_shape[1])
-            action = model.get_action(state_one_hot)
-            next_state, reward, terminate = env.take_action(action)
-
-            mask = 0 if terminate else 1
+        # create a batch of episodes
+        while alive.any():
+            action = get_action(state_table[state])
+            next_state, reward, terminate = step(action)
 
-            next_state_one_hot = convert_state2onehot(next_state, state_dim=state_shape[0] * state_shape[1])
+            reward = reward * alive
+            mask = ~terminate
+            alive = alive & mask
 
-            action_one_hot = torch.zeros(output_dim)
-            action_one_hot[action] = 1
-            replay_pool.push(state_one_hot, next_state_one_hot, action_one_hot, reward, mask)
+            push(state, None, action, reward, mask)
 
             state = next_state
 
-        loss = model.train_model(model, replay_pool.pop_all(), optimizer)
+        loss = model.train_model(net, replay_pool.pop_all(), optimizer, state_table)
 
-        print('[loss]episode %d: %.2f' % (e, loss))
+        if is_main and b % log_interval == 0:
+            print('[loss]batch %d: %.2f' % (b, loss.item()))
 
-        if e % test_interval == 0 and not e == 0:
-            scores = []
-            for _ in range(100):
-                terminate = False
-                score = 0.
-                state = env.reset()
-                while not terminate:
-                    state_one_hot = convert_state2onehot(state)
-                    action = model.get_action(state_one_hot)
-                    next_state, reward, terminate = env.take_action(action)
-                    score += reward
-                    state = next_state
-                scores.append(score)
+        if is_main and b % test_interval == 0 and not b == 0:
+            print(b, evaluate(model, test_env, state_table))
 
-            scores = np.asarray(scores)
-            print(e, np.mean(scores))
 
-
-def train_ActorCritic(env, state_shape=[4,12]):
+def train_ActorCritic(env, state_shape=[4,12], num_episodes=6000):
     model = ActorCritic(state_shape[0] * state_shape[1], env.num_actions)
 
     optimizer = optim.Adam(model.parameters(), lr=lr)
 
-    model.to(device)
+    model.to(env.device)
     model.train()
+    state_table = torch.eye(state_shape[0] * state_shape[1], device=env.device)
+    compile_forward(model, state_table[:env.batch_size])
+    net = wrap_distributed(model, env.device)
+    is_main = not is_distributed() or dist.get_rank() == 0
+    replay_pool = ReplayPool(env.batch_size, capacity=n_steps, device=env.device)
+    test_env = CliffWalking(batch_size=100, device=env.device)
+
+    step, push = env.step, replay_pool.push
+    get_action = model.get_action
 
-    for e in range(6000):
+    for b in range(num_episodes // env.batch_size):
         state = env.reset()
+        alive = torch.ones(env.batch_size, dtype=torch.bool, device=env.device)
+        replay_pool.reset()
 
-        terminate = False
         running_loss = 0.
         running_steps = 0.
-        # create an episode
-        while not terminate:
-            state_onehot = convert_state2onehot(state, state_dim=state_shape[0] * state_shape[1])
-            action = model.get_action(state_onehot)
-            next_state, reward, terminate = env.take_action(action)
-            next_state_onehot = convert_state2onehot(next_state)
+        # create a batch of episodes
+        while True:
+            action = get_action(state_table[state])
+            next_state, reward, terminate = step(action)
 
-            mask = 0 if terminate else 1
-
-            action_one_hot = torch.zeros(output_dim)
-            action_one_hot[action] = 1
-            transition = [state_onehot, next_state_onehot, action, reward, mask]
+            mask = ~terminate
+            alive = alive & mask
 
+            push(state, next_state, action, reward, mask)
             state = next_state
-            loss = model.train_model(model, transition, optimizer)
-            running_loss += loss
+
+            if len(replay_pool) == n_steps:
+                loss = model.train_model(net, replay_pool.pop_all(), optimizer, state_table)
+                replay_pool.reset()
+                running_loss += loss.detach()
+                running_steps += 1
+                # processes only agree to stop at block boundaries, so their update counts match
+                if not any_alive(alive):
+                    break
+            elif not is_distributed() and not alive.any():
+                break
+
+        if len(replay_pool) > 0:
+            loss = model.train_model(net, replay_pool.pop_all(), optimizer, state_table)
+            running_loss += loss.detach()
             running_steps += 1
 
-        print('[loss]episode %d: %.2f' % (e, running_loss / running_steps))
-
-        if e % test_interval == 0 and (not e == 0):
-            scores = []
-            model.eval()
-            for i in range(100):
-                terminate = False
-                state = env.reset()
-                score = 0
-                while not terminate:
-                    state_onehot = convert_state2onehot(state, state_dim=state_shape[0] * state_shape[1])
-                    action = model.get_action(state_onehot)
-                    next_state, reward, terminate = env.take_action(action)
-                    score += reward
-                    state = next_state
-                scores.append(score)
-            model.train()
-            print('[test score]episode %d: %.2f' % (e, np.mean(np.asarray(scores))))
+        if is_main and b % log_interval == 0:
+            print('[loss]batch %d: %.2f' % (b, (running_loss / running_steps).item()))
+
+        if is_main and b % test_interval == 0 and (not b == 0):
+            print('[test score]batch %d: %.2f' % (b, evaluate(model, test_env, state_table)))
 
 
 if __name__ == '__main__':
-    cw = CliffWalking()
+    # multi-process training: torchrun --nproc_per_node=N 13CliffWalk_Ch13.py
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        if torch.cuda.is_available():
+            dist.init_process_group(backend='nccl')
+            device = torch.device('cuda:%d' % int(os.environ['LOCAL_RANK']))
+            torch.cuda.set_device(device)
+        else:
+            dist.init_process_group(backend='gloo')
+        torch.manual_seed(1111 + dist.get_rank())
+        np.random.seed(1111 + dist.get_rank())
+
+    cw = CliffWalking(batch_size=num_envs, device=device)
     input_dim = cw.shape[0] * cw.shape[1]
     output_dim = cw.num_actions
-    print('state size:', input_dim)
-    print('action size:', output_dim)
+    if world_size == 1 or dist.get_rank() == 0:
+        print('state size:', input_dim)
+        print('action size:', output_dim)
 
-    # train_REINFORCE(cw)
-    train_ActorCritic(cw)
+    # train_REINFORCE(cw, num_episodes=6000 // world_size)
+    train_ActorCritic(cw, num_episodes=6000 // world_size)
     # test_cliff_warlking_by_hand(cw)
+
+    if world_size > 1:
+        dist.destroy_process_group()
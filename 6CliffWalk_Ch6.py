@@ -17,7 +17,7 @@ class CliffWalking(object):
         self.pos = np.asarray([self.shape[0] - 1, 0])
 
         # build a
-        self.cliff = np.zeros(self.shape, dtype=np.bool)
+        self.cliff = np.zeros(self.shape, dtype=bool)
         self.cliff[-1, 1:-1] = 1
 
         self.actions = {
@@ -44,7 +44,7 @@ class CliffWalking(object):
         self.shape = (4, 12)
         self.birth = birth
         self.pos = tuple(birth)
-        self.cliff = np.zeros(self.shape, dtype=np.bool)
+        self.cliff = np.zeros(self.shape, dtype=bool)
         self.cliff[-1, 1:-1] = 1
         self.done = False  # Show whether the game is over
         self.num_action = 4